@@ -1,7 +1,7 @@
 import dash
 from dash import html,dcc, Output, Input, ctx
 from interface import UI
-from helpers import base_query, fetch_data, aggregate_data
+from helpers import base_query, fetch_data, filter_data, product_options, aggregate_data, state_totals, state_sdud, add_aggregate_columns, load_sdud_matrix
 from figures import scatter_plot, map_fig
 from polars import col as c
 
@@ -39,25 +39,31 @@ def update_graph(product_view, state, date, product_dropdown, product_group_drop
     base = base_query(date_id=date)
 
     # if ctx.triggered_id == 'product-dropdown
-    base_data = fetch_data(base)
-    if change:
-        base_data = base_data.filter(c.classification == change)
-    
+    base = fetch_data(base)
 
-    product_groups = base_data.select(c.product_group).unique().sort(c.product_group).collect(engine='streaming').to_series().to_list()
-    if product_group_dropdown:
-        base_data = base_data.filter(c.product_group.is_in(product_group_dropdown))
-    
-    products = base_data.select(c.product).unique().sort(c.product).collect(engine='streaming').to_series().to_list()
-    if product_dropdown:
-        base_data = base_data.filter(c.product.is_in(product_dropdown))   
-    
-    state_data = aggregate_data(base_data, 'state').sort(c.diff_per_rx, descending=False).filter(c.state != 'XX').collect(engine='streaming')
+    # options only change with the date and the filters above them, so they are not rescanned per callback
+    product_groups, products = product_options(date, change, product_group_dropdown)
+    base_data = filter_data(base, change, product_group_dropdown, product_dropdown)
+
+    # without product filters the map comes from one sparse product, filtered views still scan sdud
+    matrix = load_sdud_matrix()
+    if change or product_group_dropdown or product_dropdown or matrix is None:
+        state_data = aggregate_data(base_data, 'state')
+    else:
+        state_data = state_totals(matrix, date).pipe(add_aggregate_columns)
+    state_data = state_data.sort(c.diff_per_rx, descending=False).filter(c.state != 'XX').collect(engine='streaming')
     state_fig = map_fig(state_data, map_column)
 
     state_filter = 'XX' if not state else state
 
-    fig_data = aggregate_data(base_data.filter(c.state == state_filter), 'product_group' if product_view == 'product_group' else 'product')
+    if matrix is not None and state_filter in matrix['states']:
+        # the selected state's rows come from its slice of the matrix instead of a scan of sdud
+        state_base = fetch_data(base_query(date, state_sdud(matrix, state_filter)))
+        state_base = filter_data(state_base, change, product_group_dropdown, product_dropdown)
+    else:
+        state_base = base_data.filter(c.state == state_filter)
+
+    fig_data = aggregate_data(state_base, 'product_group' if product_view == 'product_group' else 'product')
 
     fig = scatter_plot(fig_data.collect(engine='streaming'))
 
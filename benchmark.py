@@ -0,0 +1,79 @@
+import polars as pl
+from polars import col as c
+import numpy as np
+import tempfile
+import time
+from datetime import date, timedelta
+from pathlib import Path
+from update_tables import nadac_plan, sdud_plan
+from validation import new_period, nadac_source_metrics, nadac_metrics, sdud_source_metrics, sdud_metrics
+
+# compares writing the tables on their own against writing them with the validation metrics in the same run,
+# using the same plans as generate_nadac_table and generate_sdud_table on synthetic source rows
+
+
+def synthetic_nadac(n_ndcs: int = 5_000, n_weeks: int = 156, n_snapshots: int = 2) -> pl.LazyFrame:
+    """Weekly NADAC rows where each effective_date appears in n_snapshots overlapping as_of files."""
+    rng = np.random.default_rng(0)
+    n = n_ndcs * n_weeks
+    weeks = np.tile(np.arange(n_weeks), n_ndcs)
+    data = pl.DataFrame({
+        'ndc': np.repeat(np.arange(n_ndcs), n_weeks).astype(str),
+        'effective_date': np.datetime64('2022-01-03') + weeks * 7,
+        'unit_price': rng.lognormal(0, 1, n),
+        'classification': 'G',
+        'is_rx': True,
+        'explanation': None,
+    })
+    snapshots = [data.with_columns(pl.lit(date(2025, 1, 1) + timedelta(weeks=i)).alias('as_of')) for i in range(n_snapshots)]
+    return pl.concat(snapshots).lazy()
+
+def synthetic_sdud(n_ndcs: int = 10_000, n_states: int = 52, n_quarters: int = 8) -> pl.LazyFrame:
+    """Raw quarterly SDUD rows with an XX row per ndc and some suppressed state cells."""
+    rng = np.random.default_rng(0)
+    states = [f'S{i:02d}' for i in range(n_states)]
+    frames = []
+    for q in range(n_quarters):
+        units = rng.integers(1, 10_000, (n_ndcs, n_states)).astype(float)
+        xx = units.sum(axis=1)
+        units[units < 500] = np.nan
+        frames.append(pl.DataFrame({
+            'state': np.tile(states + ['XX'], n_ndcs),
+            'ndc': np.repeat(np.arange(n_ndcs), n_states + 1).astype(str),
+            'year': 2023 + q // 4,
+            'quarter': q % 4 + 1,
+            'units': np.column_stack([units, xx]).ravel(),
+            'rx_count': (np.column_stack([units, xx]) / 30).round().ravel(),
+        }, nan_to_null=True))
+    return pl.concat(frames).lazy()
+
+def time_run(run, repeat: int = 7) -> float:
+    """Best wall time of repeat runs in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def bench(name: str, outputs: list[pl.LazyFrame], metrics: list[pl.LazyFrame]) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        sinks = lambda: [data.sink_parquet(Path(tmp) / f'{name}_{i}.parquet', lazy=True) for i, data in enumerate(outputs)]
+        sink_only = time_run(lambda: pl.collect_all(sinks(), engine='streaming'))
+        with_metrics = time_run(lambda: pl.collect_all([*sinks(), *metrics], engine='streaming'))
+    print(f'{name}: sink {sink_only:.3f}s, sink + metrics {with_metrics:.3f}s, overhead {with_metrics / sink_only - 1:.1%}')
+
+
+if __name__ == "__main__":
+    # sources are written to parquet first so the plans scan files the way update_tables does
+    with tempfile.TemporaryDirectory() as sources:
+        synthetic_nadac().sink_parquet(Path(sources) / 'nadac.parquet')
+        source = pl.scan_parquet(Path(sources) / 'nadac.parquet')
+        nadac, date_id, snapshots, monthly = nadac_plan(source)
+        period = new_period(None)
+        bench('nadac', [nadac, date_id], [nadac_source_metrics(snapshots, period), nadac_metrics(monthly, period)])
+
+        synthetic_sdud().sink_parquet(Path(sources) / 'sdud.parquet')
+        raw = pl.scan_parquet(Path(sources) / 'sdud.parquet')
+        sdud, recent = sdud_plan(raw, raw.select(c.ndc).unique().collect().to_series().to_list())
+        bench('sdud', [sdud], [sdud_source_metrics(recent), sdud_metrics(sdud)])
@@ -6,7 +6,35 @@ import polars.selectors as cs
 
 SDUD_DIR = Path(r"D:\db_project\price_db_v1\db\DATA")
 NADAC = r"D:\db_project\price_db_v1\db\DATA\NADAC*.parquet"
+SDUD_MATRIX = Path("data/sdud_matrix.npz")
 MEDISPAN = r"C:\Users\mwine\3 Axis Advisors Dropbox\Matthew matt@3axisadvisors.com\datalake\assets\medispan.parquet"
+REPORT_DIR = Path("data/reports")
+
+# data quality checks run during update_tables
+PRICE_CHANGE_OUTLIER = 1.0  # abs month over month unit price change counted as an outlier
+XX_TOLERANCE = 0.01  # relative amount the sum of state units may exceed XX units per ndc
+VALIDATION_THRESHOLDS = {
+    # max: upper bound on the metric for this run
+    # drift: max relative change from the last passing run, skipped when that run was 0
+    # shift: max absolute change from the last passing run, used for rates
+    # update_tables(accept_drift=True) skips drift and shift for an expected large change
+    'nadac': {
+        # rates are over the rows added since the last passing run, at least the newest month
+        'max': {
+            'unit_price_null_rate': 0.0,
+            'price_change_outlier_rate': 0.01,
+            'conflicting_price_rate': 0.001,
+            'new_ndc_rate': 0.05,
+        },
+        'drift': {'row_count': 0.2},
+        'shift': {'price_gap_rate': 0.02},
+    },
+    'sdud': {
+        'max': {'xx_overcount_rate': 0.001},
+        'drift': {'row_count': 0.2, 'source_row_count': 0.2},
+        'shift': {'units_null_rate': 0.05, 'rx_count_null_rate': 0.05},
+    },
+}
 if __name__ == "__main__":
 
     pass
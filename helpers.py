@@ -2,7 +2,10 @@ from config import *
 import polars as pl
 from polars import col as c
 import polars.selectors as cs
+import numpy as np
 import re
+import warnings
+from functools import lru_cache
 from datetime import date
 
 def load_medispan():
@@ -26,6 +29,101 @@ def load_sdud():
     data = pl.scan_parquet('data/sdud.parquet')
     return data
 
+def table_fingerprint() -> np.ndarray:
+    """Modification times of the sdud and nadac tables, stored with the matrix built from them."""
+    return np.array([Path(path).stat().st_mtime_ns for path in ['data/sdud.parquet', 'data/nadac.parquet']])
+
+def load_sdud_matrix() -> dict[str, np.ndarray] | None:
+    """Load the state x NDC CSR arrays written by generate_sdud_matrix, None if missing or stale."""
+    if not SDUD_MATRIX.exists():
+        return None
+    # keyed on mtimes so a rebuilt matrix or table is picked up without restarting the app
+    return _load_sdud_matrix(SDUD_MATRIX.stat().st_mtime_ns, tuple(table_fingerprint()))
+
+@lru_cache(maxsize=1)
+def _load_sdud_matrix(matrix_mtime: int, fingerprint: tuple[int, ...]) -> dict[str, np.ndarray] | None:
+    with np.load(SDUD_MATRIX) as arrays:
+        matrix = {name: arrays[name] for name in arrays.files}
+    # a matrix from older tables, or one whose rebuild failed after sdud was replaced, must not be served
+    if tuple(matrix['fingerprint']) != fingerprint:
+        return None
+    if len(matrix['units']) != load_sdud().select(pl.len()).collect().item():
+        return None
+    return matrix
+
+def csr_row_sums(matrix: dict[str, np.ndarray], entries: np.ndarray) -> np.ndarray:
+    """Sum values aligned to the CSR data arrays into one total per state."""
+    n_states = len(matrix['indptr']) - 1
+    rows = np.repeat(np.arange(n_states), np.diff(matrix['indptr']))
+    return np.bincount(rows, weights=entries, minlength=n_states)
+
+def csr_matvec(matrix: dict[str, np.ndarray], values: np.ndarray, vector: np.ndarray) -> np.ndarray:
+    """Multiply a state x NDC CSR matrix by an NDC-aligned vector, one total per state."""
+    return csr_row_sums(matrix, values * vector[matrix['indices']])
+
+def state_row(matrix: dict[str, np.ndarray], state: str) -> slice:
+    """Slice of the CSR data arrays holding a single state's NDCs."""
+    i = int(np.searchsorted(matrix['states'], state))
+    if i == len(matrix['states']) or matrix['states'][i] != state:
+        raise ValueError(f'{state} is not in the sdud matrix')
+    return slice(int(matrix['indptr'][i]), int(matrix['indptr'][i + 1]))
+
+def state_sdud(matrix: dict[str, np.ndarray], state: str) -> pl.LazyFrame:
+    """One state's SDUD rows read from its CSR slice instead of scanning every state."""
+    row = state_row(matrix, state)
+    data = pl.LazyFrame({
+        'ndc': matrix['ndc_index'][matrix['indices'][row]],
+        'units': matrix['units'][row],
+        'rx_count': matrix['rx_count'][row],
+    })
+    return data.select(pl.lit(state).alias('state'), pl.all())
+
+def ndc_positions(ndc_index: np.ndarray, ndcs: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Positions of ndcs in the sorted NDC index and a mask of which ones are actually in it."""
+    position = np.searchsorted(ndc_index, ndcs)
+    if len(ndc_index) == 0:
+        return position, np.zeros(len(ndcs), dtype=bool)
+    found = ndc_index[np.minimum(position, len(ndc_index) - 1)] == ndcs
+    return position, found
+
+def nadac_price_vectors(date_id: int, ndc_index: np.ndarray) -> dict[str, np.ndarray]:
+    """NADAC prices for one month aligned to the sorted NDC index, zero where an NDC has no price."""
+    nadac = load_nadac().filter(c.date_id == date_id).select(c.ndc, c.unit_price, c.previous_unit_price).collect()
+    position, found = ndc_positions(ndc_index, nadac['ndc'].to_numpy().astype(str))
+    if not found.all():
+        # ndcs added to nadac after the matrix was built have no utilization in it
+        warnings.warn(f'{(~found).sum()} nadac ndcs are not in the sdud matrix, rerun generate_sdud_matrix')
+        nadac, position = nadac.filter(pl.Series(found)), position[found]
+    vectors = {name: np.zeros(len(ndc_index)) for name in ['priced', 'new', 'old', 'has_change']}
+    vectors['priced'][position] = 1.0
+    vectors['new'][position] = nadac['unit_price'].fill_null(0).to_numpy()
+    vectors['old'][position] = nadac['previous_unit_price'].fill_null(0).to_numpy()
+    # no previous price means no change can be measured, same as a null total_diff in fetch_data
+    vectors['has_change'][position] = (nadac['unit_price'] - nadac['previous_unit_price']).is_not_null().to_numpy()
+    return vectors
+
+def state_totals(matrix: dict[str, np.ndarray], date_id: int) -> pl.LazyFrame:
+    """Unfiltered per-state totals for one month from sparse matrix-vector products.
+
+    Dollar amounts are rounded per NDC before summing, as calculate_unit_price_change does, so the
+    totals match aggregate_data over the scan. States with no priced NDCs are left out, as in the join.
+    """
+    prices = nadac_price_vectors(date_id, matrix['ndc_index'])
+    indices, units = matrix['indices'], matrix['units']
+    new_nadac = np.round(units * prices['new'][indices], 2)
+    old_nadac = np.round(units * prices['old'][indices], 2)
+    total_diff = (new_nadac - old_nadac) * prices['has_change'][indices]
+    data = pl.LazyFrame({
+        'state': matrix['states'].tolist(),
+        'units': csr_matvec(matrix, units, prices['priced']),
+        'rx_count': csr_matvec(matrix, matrix['rx_count'], prices['priced']),
+        'total_diff': csr_row_sums(matrix, total_diff),
+        'new_nadac': csr_row_sums(matrix, new_nadac),
+        'old_nadac': csr_row_sums(matrix, old_nadac),
+        'priced_ndcs': csr_row_sums(matrix, prices['priced'][indices]),
+    })
+    return data.filter(c.priced_ndcs > 0).drop('priced_ndcs')
+
 def add_generic_name(data: pl.LazyFrame) -> pl.LazyFrame:
     return data.join(load_medispan().select(c.ndc, c.generic_name.alias('product'), c.gpi_10_generic_name.alias('product_group')), on='ndc')
 
@@ -37,8 +135,8 @@ def calculate_unit_price_change(data: pl.LazyFrame) -> pl.LazyFrame:
     return data.with_columns(unit_price_change, new_nadac, old_nadac)
 
 # base query that join nadac and sdud data
-def base_query(date_id: int) -> pl.LazyFrame:
-    sdud = load_sdud()#.filter(c.state == state)
+def base_query(date_id: int, sdud: pl.LazyFrame | None = None) -> pl.LazyFrame:
+    sdud = load_sdud() if sdud is None else sdud
     nadac = load_nadac().filter(c.date_id == date_id)
     data = sdud.join(nadac, on='ndc')
     # add generic name to the data
@@ -78,11 +176,42 @@ def fetch_data(data, **kwargs) -> pl.LazyFrame:
     data = data.with_columns((c.new_nadac - c.old_nadac).alias('total_diff')).with_columns(classification())
     return data
     
+def filter_data(data: pl.LazyFrame, change=None, product_groups=None, products=None) -> pl.LazyFrame:
+    """Apply the dashboard's change, product group and product filters."""
+    if change:
+        data = data.filter(c.classification == change)
+    if product_groups:
+        data = data.filter(c.product_group.is_in(product_groups))
+    if products:
+        data = data.filter(c.product.is_in(products))
+    return data
+
+def product_options(date_id: int, change=None, product_groups=None) -> tuple[list[str], list[str]]:
+    """Product group and product dropdown options, cached until the date, filters or tables change."""
+    product_groups = tuple(product_groups) if product_groups else None
+    groups, products = _product_options(date_id, change, product_groups, tuple(table_fingerprint()))
+    return list(groups), list(products)
+
+@lru_cache(maxsize=64)
+def _product_options(date_id: int, change, product_groups: tuple[str, ...] | None, fingerprint: tuple[int, ...]) -> tuple[tuple[str, ...], tuple[str, ...]]:
+    base = fetch_data(base_query(date_id))
+    groups = filter_data(base, change).select(c.product_group).unique().sort(c.product_group).collect(engine='streaming').to_series().to_list()
+    products = filter_data(base, change, product_groups).select(c.product).unique().sort(c.product).collect(engine='streaming').to_series().to_list()
+    return tuple(groups), tuple(products)
+
 def aggregate_data(data: pl.LazyFrame, group_by_col: str) -> pl.LazyFrame:
     data = (
         data
         .group_by(group_by_col)
         .agg(pl.col(['units','rx_count','total_diff', 'new_nadac', 'old_nadac']).sum())
+        .pipe(add_aggregate_columns)
+    )
+    return data
+
+def add_aggregate_columns(data: pl.LazyFrame) -> pl.LazyFrame:
+    """Add the derived columns used by the charts to summed totals."""
+    data = (
+        data
         .with_columns(avg_old_new_nadac())
         .with_columns(difference_per_rx())
         .with_columns(abs_diff_col(), classification(), avg_unit_change(), percent_change())
@@ -2,69 +2,118 @@ from config import *
 import polars as pl
 from polars import col as c
 import polars.selectors as cs
-from helpers import load_nadac, get_oral_solid_dosage_forms_ndcs
+import numpy as np
+from helpers import load_nadac, load_sdud, get_oral_solid_dosage_forms_ndcs, ndc_positions, table_fingerprint
+from validation import validated_sink, load_previous_report, new_period, nadac_source_metrics, nadac_metrics, sdud_source_metrics, sdud_metrics
 import re
 from datetime import date
 
 def generate_date_id_table(data):
-        (
+        return (
         data
-        .sort(c.effective_date)
         .select(c.effective_date.dt.month_start(), c.date_filter)
         .unique()
         .sort(c.effective_date)
         .with_row_index('date_id', 1)
-        .sink_parquet('data/date_id.parquet')
         )
-        return data
     
-def add_date_id(data):
-    date_id = pl.scan_parquet('data/date_id.parquet')
+def add_date_id(data, date_id):
     return data.join(date_id, on='date_filter').drop('date_filter')
 
-def generate_nadac_table():
+def nadac_plan(source: pl.LazyFrame) -> tuple[pl.LazyFrame, pl.LazyFrame, pl.LazyFrame, pl.LazyFrame]:
+    """Build the nadac and date_id tables from filtered NADAC rows, also returning the sorted source and monthly rows."""
     max_effective_date_filter = c.effective_date ==  c.effective_date.max().over(['ndc',c.effective_date.dt.month_start()])
     previous_price = c.unit_price.shift(1).over(c.ndc).alias('previous_unit_price')
     date_filter = c.effective_date.cast(pl.String).str.slice(0,7).alias('date_filter')
-    
-    (
-        pl.scan_parquet(NADAC)
-        .filter(c.classification == 'G')
-        .filter(c.is_rx)
-        .filter(c.ndc.is_in(get_oral_solid_dosage_forms_ndcs()))
-        .sort(by=['ndc','effective_date','as_of'])
+
+    # cached so the validation metrics read these rows instead of recomputing them
+    snapshots = source.sort(by=['ndc','effective_date','as_of']).cache()
+    data = (
+        snapshots
         .unique(subset=['ndc', 'effective_date'], keep='first')
         .filter(max_effective_date_filter)
         .sort(by=['ndc','effective_date'])
         .with_columns(previous_price)
         .with_columns(date_filter)
         .drop(cs.matches('(?i)as_of|explanation|classification|is_rx|updated'))
-        .pipe(generate_date_id_table)
-        .pipe(add_date_id)
-        .sink_parquet('data/nadac.parquet')
+        .cache()
     )
+    date_id = generate_date_id_table(data)
+    return add_date_id(data, date_id), date_id, snapshots, data
 
-def generate_sdud_table():
-    """Load the SDUD dataset."""
-    #get current year
-    current_year = date.today().year
-    # return if file name contains 2023 or 2024
-    files = [file for file in SDUD_DIR.iterdir() if re.match(r'(?i)state', file.name) and re.search(rf'{current_year}|{current_year-1}|{current_year-2}', file.name)]
-    data = pl.scan_parquet(files)
+def generate_nadac_table(accept_drift: bool = False):
+    source = (
+        pl.scan_parquet(NADAC)
+        .filter(c.classification == 'G')
+        .filter(c.is_rx)
+        .filter(c.ndc.is_in(get_oral_solid_dosage_forms_ndcs()))
+    )
+    nadac, date_id, snapshots, monthly = nadac_plan(source)
+    period = new_period(load_previous_report('nadac'))
+    # date_id is staged with nadac so a failed refresh leaves both tables as they were
+    outputs = {'data/nadac.parquet': nadac, 'data/date_id.parquet': date_id}
+    validated_sink(outputs, 'nadac', [nadac_source_metrics(snapshots, period), nadac_metrics(monthly, period)], accept_drift)
+
+def sdud_plan(data: pl.LazyFrame, ndcs: list[str]) -> tuple[pl.LazyFrame, pl.LazyFrame]:
+    """Build the sdud table from raw SDUD rows, also returning the raw rows of the last four quarters."""
     most_recent = data.select(c.year,c.quarter).unique().sort(c.year, c.quarter, descending=True).head(4)
+    # cached so the validation metrics read these rows instead of rescanning the files
+    recent = data.join(most_recent, on= ['year', 'quarter'],).cache()
     data = (
-        data
-        .join(most_recent, on= ['year', 'quarter'],)
+        recent
         .group_by(c.state, c.ndc)
         .agg(cs.matches('(?i)units|rx').cast(pl.Float64).sum())
-        .filter(c.ndc.is_in(load_nadac().select(c.ndc).collect().to_series().to_list()))
+        .filter(c.ndc.is_in(ndcs))
     )
-    data.sink_parquet('data/sdud.parquet')
+    return data, recent
+
+def generate_sdud_table(accept_drift: bool = False):
+    """Load the SDUD dataset."""
+    #get current year
+    current_year = date.today().year
+    # return if file name contains 2023 or 2024
+    files = [file for file in SDUD_DIR.iterdir() if re.match(r'(?i)state', file.name) and re.search(rf'{current_year}|{current_year-1}|{current_year-2}', file.name)]
+    data, recent = sdud_plan(pl.scan_parquet(files), load_nadac().select(c.ndc).collect().to_series().to_list())
+    validated_sink({'data/sdud.parquet': data}, 'sdud', [sdud_source_metrics(recent), sdud_metrics(data)], accept_drift)
+    generate_sdud_matrix()
     return data
 
-def update_tables():
-    """Generate all necessary tables."""
+def generate_sdud_matrix():
+    """Write SDUD as state x NDC CSR arrays aligned to the sorted NADAC NDC index, tagged with the tables it was built from."""
+    ndc_index = load_nadac().select(c.ndc).unique().sort(c.ndc).collect().to_series().to_numpy().astype(str)
+    sdud = load_sdud().select(c.state, c.ndc, c.units, c.rx_count).sort(c.state, c.ndc).collect()
+    states = sdud.select(c.state).unique().sort(c.state).to_series().to_numpy().astype(str)
+
+    # rows are sorted by state then ndc, so counting rows per state gives the CSR row pointer
+    row = np.searchsorted(states, sdud['state'].to_numpy().astype(str))
+    indptr = np.zeros(len(states) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row, minlength=len(states)), out=indptr[1:])
+    indices, found = ndc_positions(ndc_index, sdud['ndc'].to_numpy().astype(str))
+    if not found.all():
+        raise ValueError(f'{(~found).sum()} sdud rows have ndcs missing from nadac, rerun generate_sdud_table')
+
+    # one file renamed into place so a reader never sees arrays from two different builds
+    staging = SDUD_MATRIX.with_suffix('.staging.npz')
+    with open(staging, 'wb') as file:
+        np.savez(
+            file,
+            ndc_index=ndc_index,
+            states=states,
+            indptr=indptr,
+            indices=indices.astype(np.int64),
+            units=sdud['units'].to_numpy(),
+            rx_count=sdud['rx_count'].to_numpy(),
+            fingerprint=table_fingerprint(),
+        )
+    staging.replace(SDUD_MATRIX)
+
+def update_tables(accept_drift: bool = False):
+    """Generate all necessary tables.
+
+    Pass accept_drift=True when a large change from the last refresh is expected, such as a
+    new SDUD year; the max thresholds in VALIDATION_THRESHOLDS still apply.
+    """
     Path('data').mkdir(parents=True, exist_ok=True)
-    generate_nadac_table()
-    generate_sdud_table()
+    generate_nadac_table(accept_drift)
+    generate_sdud_table(accept_drift)
     return True
\ No newline at end of file
@@ -0,0 +1,143 @@
+from config import *
+import polars as pl
+from polars import col as c
+from datetime import datetime
+
+
+class DataQualityError(Exception):
+    """Raised when a table refresh fails its VALIDATION_THRESHOLDS."""
+
+
+def new_period(previous: dict | None) -> pl.Expr:
+    """Rows added since the last passing report, and always at least the newest month.
+
+    Checked over the whole history back to 2013, one bad week would be averaged away.
+    """
+    start = c.effective_date.max().dt.month_start()
+    if previous and previous.get('max_effective_date'):
+        start = pl.min_horizontal(start, pl.lit(previous['max_effective_date']) + pl.duration(days=1))
+    return c.effective_date >= start
+
+def nadac_source_metrics(data: pl.LazyFrame, period: pl.Expr) -> pl.LazyFrame:
+    """Metrics on the filtered NADAC rows sorted by ndc, effective_date and as_of, before de-duplication."""
+    # overlapping as_of snapshots repeat an (ndc, effective_date) on purpose, only a different price is a conflict
+    same_date = (c.ndc == c.ndc.shift(1)) & (c.effective_date == c.effective_date.shift(1))
+    conflict = same_date & (c.unit_price != c.unit_price.shift(1))
+    return data.select(
+        pl.len().alias('source_row_count'),
+        conflict.filter(period).mean().alias('conflicting_price_rate'),
+    )
+
+def nadac_metrics(data: pl.LazyFrame, period: pl.Expr) -> pl.LazyFrame:
+    """Metrics on the monthly NADAC rows sorted by ndc and effective_date, before date_id is joined."""
+    price_change = (c.unit_price / c.previous_unit_price - 1).abs()
+    # an ndc's first month has no previous price, so its percent_change bubble has nothing to compare to
+    first_month = (c.ndc != c.ndc.shift(1)).fill_null(True)
+    month = c.effective_date.dt.year() * 12 + c.effective_date.dt.month()
+    # shift(1) over ndc pairs the price with the last month that had one, however long ago that was
+    skipped_month = ~first_month & (month - month.shift(1) > 1)
+    return data.select(
+        pl.len().alias('row_count'),
+        c.effective_date.max().alias('max_effective_date'),
+        period.sum().alias('period_row_count'),
+        c.unit_price.is_null().filter(period).mean().alias('unit_price_null_rate'),
+        (price_change > PRICE_CHANGE_OUTLIER).filter(period).mean().alias('price_change_outlier_rate'),
+        first_month.filter(period).mean().alias('new_ndc_rate'),
+        skipped_month.filter(period).mean().alias('price_gap_rate'),
+    )
+
+def sdud_source_metrics(data: pl.LazyFrame) -> pl.LazyFrame:
+    """Metrics on the raw SDUD rows before they are summed, where suppressed cells are still null."""
+    return data.select(
+        pl.len().alias('source_row_count'),
+        (c.units.null_count() / pl.len()).alias('units_null_rate'),
+        (c.rx_count.null_count() / pl.len()).alias('rx_count_null_rate'),
+    )
+
+def sdud_metrics(data: pl.LazyFrame) -> pl.LazyFrame:
+    """Metrics on the SDUD table as written, including XX against the sum of states."""
+    totals = data.select(pl.len().alias('row_count'))
+    xx_units = c.units.filter(c.state == 'XX').sum().alias('xx_units')
+    state_units = c.units.filter(c.state != 'XX').sum().alias('state_units')
+    # XX keeps the small cells that are suppressed in the state rows, so it is normally larger;
+    # states adding up to more than XX means rows are being double counted
+    overcount = c.state_units > (1 + XX_TOLERANCE) * c.xx_units
+    xx_check = (
+        data
+        .group_by(c.ndc)
+        .agg(xx_units, state_units)
+        .select(overcount.mean().alias('xx_overcount_rate'))
+    )
+    return pl.concat([totals, xx_check], how='horizontal')
+
+def load_previous_report(table: str) -> dict | None:
+    """Most recent passing report for a table, if there is one."""
+    for file in sorted(REPORT_DIR.glob(f'{table}_*.parquet'), reverse=True):
+        report = pl.read_parquet(file).row(0, named=True)
+        if report['passed']:
+            return report
+    return None
+
+def check_thresholds(report: dict, previous: dict | None, thresholds: dict) -> list[str]:
+    """Return a message for every metric outside its threshold."""
+    failures = []
+    for metric, limit in thresholds['max'].items():
+        if report[metric] is not None and report[metric] > limit:
+            failures.append(f'{metric} {report[metric]:.4g} > {limit}')
+    if previous is None:
+        return failures
+    for metric, limit in thresholds['drift'].items():
+        old, new = previous.get(metric), report[metric]
+        # relative change means nothing against a zero baseline
+        if not old or new is None:
+            continue
+        change = abs(new - old) / abs(old)
+        if change > limit:
+            failures.append(f'{metric} drifted {change:.1%} from {old:.4g} to {new:.4g} (limit {limit:.0%})')
+    for metric, limit in thresholds['shift'].items():
+        old, new = previous.get(metric), report[metric]
+        if old is None or new is None:
+            continue
+        if abs(new - old) > limit:
+            failures.append(f'{metric} shifted from {old:.4g} to {new:.4g} (limit {limit})')
+    return failures
+
+def write_report(table: str, report: dict, failures: list[str], accept_drift: bool) -> Path:
+    """Persist one run's metrics and outcome to REPORT_DIR."""
+    run_at = datetime.now()
+    REPORT_DIR.mkdir(parents=True, exist_ok=True)
+    path = REPORT_DIR / f'{table}_{run_at:%Y%m%dT%H%M%S%f}.parquet'
+    (
+        pl.DataFrame([report])
+        .with_columns(
+            pl.lit(table).alias('table'),
+            pl.lit(run_at).alias('run_at'),
+            pl.lit(not failures).alias('passed'),
+            pl.lit(accept_drift).alias('accept_drift'),
+            pl.lit(failures, dtype=pl.List(pl.String)).alias('failures'),
+        )
+        .write_parquet(path)
+    )
+    return path
+
+def validated_sink(outputs: dict[str, pl.LazyFrame], table: str, metrics: list[pl.LazyFrame], accept_drift: bool = False) -> dict:
+    """Sink tables and compute their metrics in one streaming run, only replacing the paths if they pass.
+
+    accept_drift skips the drift and shift checks, for a refresh where a large change is expected.
+    The run's report then becomes the baseline that later refreshes are compared against.
+    """
+    staging = {Path(path): Path(path).with_suffix('.staging.parquet') for path in outputs}
+    sinks = [data.sink_parquet(staging[Path(path)], lazy=True) for path, data in outputs.items()]
+    # one run for sinks and metrics, the plans cache the rows they share so nothing is scanned twice
+    results = pl.collect_all([*sinks, *metrics], engine='streaming')[len(sinks):]
+    report = pl.concat(results, how='horizontal').row(0, named=True)
+    previous = None if accept_drift else load_previous_report(table)
+    failures = check_thresholds(report, previous, VALIDATION_THRESHOLDS[table])
+    write_report(table, report, failures, accept_drift)
+    if failures:
+        kept = ', '.join(str(file) for file in staging.values())
+        raise DataQualityError(f'{table} refresh failed validation, kept {kept}: ' + '; '.join(failures))
+    # promote together so the tables written by one refresh never get out of step
+    for path, file in staging.items():
+        file.replace(path)
+    return report